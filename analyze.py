@@ -5,10 +5,13 @@ SCRIPT_NAME = 'analyze.py'
 VERSION = 1.0
 
 import locsutil as lu
-import math
 import os
+import numpy as np
+import numexpr as ne
 import pandas as pd
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from datetime import datetime
 import time
 
@@ -71,43 +74,47 @@ def main():
     # Starts a timer.
     start = time.time()
 
-    # Finds locs data to be analyzed.
-    os.chdir(input_path)
-    hdf5_list = lu.get_hdf_list()
+    # Finds locs data to be analyzed. Paths stay absolute so workers do not depend on the cwd.
+    hdf5_list = lu.get_hdf_list(os.path.abspath(input_path))
     print(hdf5_list)
 
-    # Analyzes each file and generates output table.
-    all_data = pd.DataFrame()
+    now = datetime.now().strftime('%Y-%m-%d-%H%M%S')
+    out_name = os.path.join(input_path, f'{out_postfix}_{int(bin_xy)}xy_{int(bin_z)}z_{now}.csv')
 
-    for item in hdf5_list:
-        print('Analyzing...' + item)
+    # Analyzes each file in a separate process and streams its rows to the output table.
+    # The global center of mass and the distances are per file, so no file needs the others.
+    row_offset = 0
 
-        analyzed = analyze_data(item, pixel_size, bin_xy, bin_z)
-        all_data = pd.concat([all_data, analyzed], ignore_index=True)
+    with ProcessPoolExecutor() as executor, open(out_name, 'w', newline='') as out_file:
+        analyzed_iter = executor.map(analyze_data, hdf5_list, repeat(pixel_size), repeat(bin_xy), repeat(bin_z))
 
-    # Normalizes the coordinate based on the global center of mass of each data.
-    all_data = normalize_coms(all_data)
-    all_data = calc_dist(all_data)
+        for analyzed in analyzed_iter:
+            # Normalizes the coordinate based on the global center of mass of each data.
+            analyzed = normalize_coms(analyzed)
+            analyzed = calc_dist(analyzed)
 
-    print(all_data)
+            print(analyzed)
 
-    # Organizes table.
-    all_data = all_data[COLUMNS]
+            # Organizes table.
+            analyzed = analyzed[COLUMNS]
 
-    all_data['s_to_v'] = all_data['surf_area'] / (all_data['vol_vox'] ** (2/3))  # Dimension-less S/V
-    all_data['density'] = all_data['total_locs'] / all_data['vol_vox'] * 1e9
+            analyzed['s_to_v'] = analyzed['surf_area'] / (analyzed['vol_vox'] ** (2/3))  # Dimension-less S/V
+            analyzed['density'] = analyzed['total_locs'] / analyzed['vol_vox'] * 1e9
 
-    # Outputs table.
-    now = datetime.now().strftime('%Y-%m-%d-%H%M%S')
-    out_name = f'{out_postfix}_{int(bin_xy)}xy_{int(bin_z)}z_{now}.csv'
-    all_data.to_csv(out_name)
+            # Appends to the output table, numbering rows across files.
+            analyzed.index = np.arange(row_offset, row_offset + len(analyzed))
+            analyzed.to_csv(out_file, header=(out_file.tell() == 0))
+            row_offset += len(analyzed)
 
     print(f'Total_time: {time.time() - start} [sec]')
 
 
 def analyze_data(file, pixel_size: float, bin_xy: float, bin_z: float) -> pd.DataFrame:
 
-    status = lu.get_status(file)
+    print('Analyzing...' + file)
+
+    file_base = os.path.basename(file)
+    status = lu.get_status(file_base)
     data = lu.read_locs(file)
     data = data[data['id'] != -1]
     data = lu.convert_xy(data, pixel_size)
@@ -115,7 +122,7 @@ def analyze_data(file, pixel_size: float, bin_xy: float, bin_z: float) -> pd.Dat
 
     analyzed = analyze_clusters(data, bin_xy, bin_z)
 
-    analyzed['file'] = file
+    analyzed['file'] = file_base
     analyzed['status'] = status
 
     return analyzed
@@ -123,146 +130,136 @@ def analyze_data(file, pixel_size: float, bin_xy: float, bin_z: float) -> pd.Dat
 
 def analyze_clusters(locs: pd.DataFrame, bin_xy: float, bin_z: float) -> pd.DataFrame:
 
-    decode_id = []
-    total_locs = []
-    com_x = []
-    com_y = []
-    com_z = []
-    num_vox = []
-    surf_vox = []
-    vol_vox = []
-    surf_area = []
-    rg = []
+    # Sorts once by (id, hdbscan); every per-id and per-cluster pass below reads contiguous runs.
+    # Locs without a decoded id (NaN) are left out, as groupby('id') drops them.
+    locs = locs[['id', 'hdbscan', 'x_nm', 'y_nm', 'z', 'x_vox', 'y_vox', 'z_vox']]
+    locs = locs[np.isfinite(locs['id'].to_numpy())]
+    locs = locs.iloc[np.lexsort((locs['hdbscan'].to_numpy(), locs['id'].to_numpy()))]
+
+    ret_df = calc_com(locs)
 
-    for i, locs_group in locs.groupby('id'):
+    # Counts voxels of each h/dbscan cluster and sums them up per decoded id.
+    counted = count_voxels(locs)
 
-        decode_id += [i]
-        total_locs += [len(locs_group)]
+    ret_df['total_vox'] = counted['total_vox']
+    ret_df['total_surf_vox'] = counted['total_surf_vox']
 
-        com = calc_com(locs_group)
-        com_x += [com[0]]
-        com_y += [com[1]]
-        com_z += [com[2]]
+    ret_df['vol_vox'] = counted['total_vox'] * (bin_xy ** 2) * bin_z
+    ret_df['surf_area'] = counted['xy_faces'] * bin_xy * bin_z \
+        + counted['z_faces'] * (bin_xy ** 2)
 
-        total_vox = 0.0
-        total_surf_vox = 0.0
-        total_xy_faces = 0.0
-        total_z_faces = 0.0
+    ret_df['rg'] = gyration_radius(locs, ret_df)
 
-        for dbscan, dbscan_group in locs_group.groupby('hdbscan'):
-            calculated, vol, surf, xy_faces, z_faces = lu.count_exposed_faces(dbscan_group)
+    return ret_df.reset_index()
 
-            total_vox += vol
-            total_surf_vox += surf
-            total_xy_faces += xy_faces
-            total_z_faces += z_faces
 
-        num_vox += [total_vox]
-        surf_vox += [total_surf_vox]
+def count_voxels(locs: pd.DataFrame) -> pd.DataFrame:
+    # Should contain the following columns: id, hdbscan, x_vox, y_vox, z_vox
+    # Should be sorted by (id, hdbscan) so that each h/dbscan cluster is a contiguous slice.
 
-        vol_vox += [total_vox * (bin_xy ** 2) * bin_z]
-        surf_area += [total_xy_faces * bin_xy *
-                      bin_z + total_z_faces * (bin_xy ** 2)]
+    ids = locs['id'].to_numpy()
+    clusters = locs['hdbscan'].to_numpy()
+    vox = locs[['x_vox', 'y_vox', 'z_vox']].to_numpy(dtype=np.int64)
 
-        rg += [gyration_radius(locs_group, com)]
+    starts = run_starts(ids, clusters)
+    ends = np.append(starts[1:], len(ids))
 
-    ret_df = pd.DataFrame(
-        data={'id': decode_id, 'total_locs': total_locs,
-              'com_x': com_x, 'com_y': com_y, 'com_z': com_z,
-              'total_vox': num_vox, 'total_surf_vox': surf_vox,
-              'vol_vox': vol_vox, 'surf_area': surf_area, 'rg': rg},
-    )
+    counted = np.empty((len(starts), 4), dtype=np.float64)
 
-    return ret_df
+    for k, (start, end) in enumerate(zip(starts, ends)):
+        calculated, total_vox, surf_vox, xy_faces, z_faces = lu.count_exposed_faces(vox[start:end])
+        counted[k] = total_vox, surf_vox, xy_faces, z_faces
+
+    counted = pd.DataFrame(counted, index=ids[starts],
+                           columns=['total_vox', 'total_surf_vox', 'xy_faces', 'z_faces'])
+
+    return counted.groupby(level=0, sort=False).sum()
 
 
 def normalize_coms(analyzed: pd.DataFrame) -> pd.DataFrame:
     # Should contain the following columns: com_x, com_y, com_z
 
-    global_coms = calc_global_coms(analyzed)
-    merged = analyzed.merge(global_coms, on='file')
+    global_coms = calc_global_coms(analyzed).set_index('file')
 
-    merged['rel_com_x'] = merged['com_x'] - merged['global_com_x']
-    merged['rel_com_y'] = merged['com_y'] - merged['global_com_y']
-    merged['rel_com_z'] = merged['com_z'] - merged['global_com_z']
+    # Broadcasts the per-file COM onto each row by a lookup rather than a join.
+    for axis in ['x', 'y', 'z']:
+        analyzed[f'global_com_{axis}'] = analyzed['file'].map(global_coms[f'global_com_{axis}'])
+        analyzed[f'rel_com_{axis}'] = analyzed[f'com_{axis}'] - analyzed[f'global_com_{axis}']
 
-    return merged
+    return analyzed
 
 
 def calc_global_coms(analyzed: pd.DataFrame) -> pd.DataFrame:
     # Should contain the following columns: com_x, com_y, com_z
 
-    file_list = []
-    mean_comx_list = []
-    mean_comy_list = []
-    mean_comz_list = []
+    global_coms = analyzed.groupby('file', sort=False)[['com_x', 'com_y', 'com_z']].mean()
+    global_coms = global_coms.rename(columns={'com_x': 'global_com_x',
+                                              'com_y': 'global_com_y',
+                                              'com_z': 'global_com_z'})
 
-    for key, grouped in analyzed.groupby('file'):
-        file_list.append(key)
+    return global_coms.reset_index()
 
-        mean_comx_list.append(grouped['com_x'].mean())
-        mean_comy_list.append(grouped['com_y'].mean())
-        mean_comz_list.append(grouped['com_z'].mean())
 
-    return pd.DataFrame(
-        data={'file': file_list,
-              'global_com_x': mean_comx_list,
-              'global_com_y': mean_comy_list,
-              'global_com_z': mean_comz_list}
-    )
+def calc_com(locs: pd.DataFrame) -> pd.DataFrame:
+    # Returns the number of locs and the center of mass of each decoded id.
+    # Should be sorted by 'id'.
 
+    ids = locs['id'].to_numpy()
 
-def calc_com(locs: pd.DataFrame) -> list:
+    starts = run_starts(ids)
+    counts = np.diff(np.append(starts, len(ids)))
 
-    com_x = locs['x_nm'].mean()
-    com_y = locs['y_nm'].mean()
-    com_z = locs['z'].mean()
+    coms = {'total_locs': counts}
+    for com_col, col in [('com_x', 'x_nm'), ('com_y', 'y_nm'), ('com_z', 'z')]:
+        coms[com_col] = np.add.reduceat(locs[col].to_numpy(), starts, dtype=np.float64) / counts
 
-    return [com_x, com_y, com_z]
+    return pd.DataFrame(coms, index=pd.Index(ids[starts], name='id'))
+
+
+def run_starts(*keys: np.ndarray) -> np.ndarray:
+    # Returns the first index of each run of equal keys in sorted arrays.
+
+    is_first = np.zeros(len(keys[0]), dtype=bool)
+    is_first[:1] = True
+    for key in keys:
+        is_first[1:] |= key[1:] != key[:-1]
+
+    return np.flatnonzero(is_first)
 
 
 def calc_dist(analyzed: pd.DataFrame) -> pd.DataFrame:
     # Should contain the following columns: com_x, com_y, com_z
+    # Distance between each id and the next id (id + 1) in the same file.
 
-    out_list = []
-
-    for key, grouped in analyzed.groupby('file'):
+    ordered = analyzed.sort_values(by=['file', 'id'])
+    following = ordered.groupby('file', sort=False)[['id', 'com_x', 'com_y', 'com_z']].shift(-1)
 
-        grouped.sort_values(by='id', inplace=True)
-        grouped.reset_index(drop=True, inplace=True)
+    consecutive = following['id'] == ordered['id'] + 1
 
-        for index, row in grouped.iterrows():
-            try:
-                if grouped.at[index, 'id'] + 1 == grouped.at[index + 1, 'id']:
-                    _x1 = grouped.at[index, 'com_x']
-                    _y1 = grouped.at[index, 'com_y']
-                    _z1 = grouped.at[index, 'com_z']
-                    _x2 = grouped.at[index + 1, 'com_x']
-                    _y2 = grouped.at[index + 1, 'com_y']
-                    _z2 = grouped.at[index + 1, 'com_z']
-                    _distance = (
-                        (_x2 - _x1) ** 2
-                        + (_y2 - _y1) ** 2
-                        + (_z2 - _z1) ** 2
-                    ) ** 0.5
-                    out_list.append([key, grouped.at[index, 'id'], _distance])
-            except:
-                pass
+    _dx = following['com_x'] - ordered['com_x']
+    _dy = following['com_y'] - ordered['com_y']
+    _dz = following['com_z'] - ordered['com_z']
 
-    df_dist = pd.DataFrame(out_list, columns=['file', 'id', 'distance'])
+    analyzed['distance'] = np.sqrt(_dx * _dx + _dy * _dy + _dz * _dz).where(consecutive)
 
-    return analyzed.merge(df_dist, on=['file', 'id'], how='outer')
+    return analyzed
 
 
-def gyration_radius(locs: pd.DataFrame, com: list) -> float:
+def gyration_radius(locs: pd.DataFrame, coms: pd.DataFrame) -> pd.Series:
+    # coms should be indexed by 'id' and contain the following columns: com_x, com_y, com_z
 
-    data = locs.copy()
+    lookup = coms.index.get_indexer(locs['id'])
 
-    data['r^2'] = (data['x_nm'] - com[0]) ** 2 \
-        + (data['y_nm'] - com[1]) ** 2 \
-        + (data['z'] - com[2]) ** 2
+    # Evaluates r^2 in one fused pass, without materializing the displacement arrays.
+    r_2 = ne.evaluate('(x - cx)**2 + (y - cy)**2 + (z - cz)**2',
+                      local_dict={'x': locs['x_nm'].to_numpy(),
+                                  'y': locs['y_nm'].to_numpy(),
+                                  'z': locs['z'].to_numpy(),
+                                  'cx': coms['com_x'].to_numpy()[lookup],
+                                  'cy': coms['com_y'].to_numpy()[lookup],
+                                  'cz': coms['com_z'].to_numpy()[lookup]})
 
-    return math.sqrt(data['r^2'].sum() / data.shape[0])
+    return np.sqrt(pd.Series(r_2).groupby(locs['id'].to_numpy(), sort=False).mean())
 
 
 if __name__ == '__main__':
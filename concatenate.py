@@ -5,6 +5,7 @@ SCRIPT_NAME = 'concatenate.py'
 VERSION = 1.0
 
 import argparse
+import numpy as np
 import pandas as pd
 from glob import glob
 import os
@@ -73,55 +74,55 @@ def main():
     max_photons = args.maxphoton
     out_name = args.output
     
-    os.chdir(input_path)
-    hdf5_list = lu.get_hdf_list()
+    hdf5_list = lu.get_hdf_list(input_path)
     print(hdf5_list)
 
-    outdata = pd.DataFrame()
+    # Imports the yaml file shared by the Z-series.
+    yaml_in = glob(os.path.join(input_path, '*.yaml'))[0]
+    frame_val, height_val, width_val = lu.read_yaml(yaml_in)
 
-    off_val = 0
-    z_val = 0
+    data_list = []
 
     for item in hdf5_list:
         print(item)
         data = lu.read_locs(item)
         data = lu.clean_locs(data, max_dzcalib, max_locs_precision, min_z, max_z, max_photons)
+        data_list.append(data)
 
-        outdata, _off = concat_z(outdata, data, off_val, z_val)
-        off_val = off_val + _off
-        z_val = z_val + z_step
-
-    # Imports a yaml file
-    yaml_in = glob('*.yaml')[0]
-    frame_val, height_val, width_val = lu.read_yaml(yaml_in)
+    outdata = concat_z(data_list, z_step)
     
     total_frame_val = str(int(frame_val) * int(len(hdf5_list)))
 
     # Generates output file names
-    out_hdf5_name = out_name + '.hdf5'
-    out_yaml_name = out_name + '.yaml'
+    out_hdf5_name = os.path.join(input_path, out_name) + '.hdf5'
+    out_yaml_name = os.path.join(input_path, out_name) + '.yaml'
 
     # Outputs drift concatenated files
     lu.write_locs(outdata, out_hdf5_name)
     lu.write_yaml(total_frame_val, height_val, width_val, out_yaml_name)
 
 
-def concat_z(df1, df2, frame_offset, z_offset):
+def concat_z(locs_list: list, z_step: int) -> pd.DataFrame:
     # Input form: frame, x, y, photons, sx, sy, bg, lpx, lpy, ellipticity, net_gradient, z, d_zcalib
+    # Shifts frames and z of each data in the list in place, then concatenates them at once.
     
-    # Reads in from HDF5
-    data1 = df1.copy()
-    data2 = df2.copy()
-    
-    # Reads in from HDF5
-    last_frame = int(data2['frame'].iloc[-1]) + 1
+    shifted = []
     
-    data2['frame'] = data2['frame'].astype('int') + int(frame_offset)
-    data2['z'] = data2['z'].astype('float') + int(z_offset)
+    frame_offset = 0
+    z_offset = 0
     
-    data_out = pd.concat([data1, data2], ignore_index=True)
+    for data in locs_list:
+        last_frame = int(data['frame'].iloc[-1]) + 1
+        
+        # Adds the offsets on the underlying arrays in the output types; casts only if needed.
+        data['frame'] = data['frame'].to_numpy(lu.LOCS_DTYPES['frame']) + np.uint32(frame_offset)
+        data['z'] = data['z'].to_numpy(lu.LOCS_DTYPES['z']) + np.float32(z_offset)
+        shifted.append(data)
+        
+        frame_offset = frame_offset + last_frame
+        z_offset = z_offset + z_step
     
-    return data_out, last_frame
+    return pd.concat(shifted, ignore_index=True)
 
 
 if __name__ == '__main__':
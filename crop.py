@@ -66,8 +66,8 @@ def main():
     max_z = args.maxz
     size = args.size
     
-    # Imports locs file.
-    data = lu.read_locs(in_file)
+    # Imports locs file as column arrays.
+    data = lu.read_locs_soa(in_file)
     
     # Gets working directory path.
     work_dir = os.path.dirname(in_file)
@@ -79,7 +79,7 @@ def main():
         out_data = crop_z(out_data, min_z, max_z)
 
     # Imports a yaml file.
-    yaml_in = in_file.rstrip('hdf5') + 'yaml'
+    yaml_in = os.path.splitext(in_file)[0] + '.yaml'
     frame_val, height_val, width_val = lu.read_yaml(yaml_in)
 
     # Generates output file name prefix.
@@ -96,11 +96,11 @@ def main():
     out_yaml_name = os.path.join(work_dir, out_name) + '.yaml'
 
     # Outputs cropped files.
-    lu.write_locs(out_data, out_hdf5_name)
+    lu.write_locs(pd.DataFrame(out_data), out_hdf5_name)
     lu.write_yaml(frame_val, size, size, out_yaml_name)
 
 
-def crop_xy(locs_data: pd.DataFrame, min_x: float, min_y: float, width: float) -> pd.DataFrame:
+def crop_xy(locs_data: dict, min_x: float, min_y: float, width: float) -> dict:
     """
     Crops localization data using given x & y coordinates and width.
     For Picasso localization data, x and y are in camera-pixel scale.
@@ -111,8 +111,8 @@ def crop_xy(locs_data: pd.DataFrame, min_x: float, min_y: float, width: float) -
 
     Parameters
     ----------
-    locs_data : pd.DataFrame
-        Localization data.
+    locs_data : dict of np.array
+        Localization data, keyed by column name.
     min_x : float
         x of the top-left corner of the cropping square.
     min_y : float
@@ -122,17 +122,18 @@ def crop_xy(locs_data: pd.DataFrame, min_x: float, min_y: float, width: float) -
 
     Returns
     -------
-    cropped : pd.DataFrame
+    cropped : dict of np.array
 
     """
     
     max_x = min_x + width
     max_y = min_y + width
     
-    cropped = locs_data.copy()
+    x = locs_data['x']
+    y = locs_data['y']
+    in_square = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
     
-    cropped = cropped[(cropped['x'] >= min_x) & (cropped['x'] <= max_x)]
-    cropped = cropped[(cropped['y'] >= min_y) & (cropped['y'] <= max_y)]
+    cropped = {col: values[in_square] for col, values in locs_data.items()}
     
     cropped['x'] -= min_x
     cropped['y'] -= min_y
@@ -140,25 +141,27 @@ def crop_xy(locs_data: pd.DataFrame, min_x: float, min_y: float, width: float) -
     return cropped
 
 
-def crop_z(locs_data: pd.DataFrame, min_z: float, max_z: float) -> pd.DataFrame:
+def crop_z(locs_data: dict, min_z: float, max_z: float) -> dict:
     """
     Crops localization data using given a z height range.
 
     Parameters
     ----------
-    locs_data : pd.DataFrame
-        Localization data.
+    locs_data : dict of np.array
+        Localization data, keyed by column name.
     min_z : float
     max_z : float
 
     Returns
     -------
-    cropped : pd.DataFrame
+    cropped : dict of np.array
 
     """
     
-    cropped = locs_data.copy()
-    cropped = cropped[(cropped['z'] >= min_z) & (cropped['z'] <= max_z)]
+    z = locs_data['z']
+    in_range = (z >= min_z) & (z <= max_z)
+    
+    cropped = {col: values[in_range] for col, values in locs_data.items()}
     
     return cropped
 
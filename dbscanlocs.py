@@ -6,15 +6,16 @@ VERSION = 1.0
 
 from glob import glob
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import os
+import numpy as np
 import pandas as pd
 from sklearn.cluster import DBSCAN
 import locsutil as lu
 import time
 import random
 
-random.seed(0)
-
 MESSAGE = f"""
 %s version %s. Requires a path to DNA-PAINT localization file (HDF5) or a directory containing
 localization files. Optionally takes in the DBSCAN parameters.
@@ -72,9 +73,10 @@ def main():
         query = os.path.join(input_path, '*.hdf5')
         locs_files = glob(query)
 
-        for item in locs_files:
-            print('Processing...' + item)
-            find_cluster(item, pixel_size, epsilon, min_samples, min_threshold)
+        # Processes files in parallel; each DBSCAN then runs on a single core (n_jobs=1).
+        with ProcessPoolExecutor() as executor:
+            list(executor.map(find_cluster, locs_files, repeat(pixel_size), repeat(epsilon),
+                              repeat(min_samples), repeat(min_threshold), repeat(1)))
     else:
         find_cluster(input_path, pixel_size, epsilon, min_samples, min_threshold)
     
@@ -82,7 +84,8 @@ def main():
     print('Elapsed_time:{0}'.format(elapsed_time) + '[sec]')
 
 
-def find_cluster(file: str, pixel_size: float, epsilon: float, min_sample: int, threshold: int):
+def find_cluster(file: str, pixel_size: float, epsilon: float, min_sample: int, threshold: int,
+                 n_jobs: int = -1):
     """
     Segments localization data into clusters using the DBSCAN algorithm.
     
@@ -98,6 +101,8 @@ def find_cluster(file: str, pixel_size: float, epsilon: float, min_sample: int,
         The desired minimum cluster size.
     threshold : int
         Cutoff of the cluster size after segmentation.
+    n_jobs : int, optional
+        Number of cores used by DBSCAN neighbor queries, default = -1 (all cores).
         
     Returns
     -------
@@ -105,20 +110,26 @@ def find_cluster(file: str, pixel_size: float, epsilon: float, min_sample: int,
 
     """
 
+    print('Processing...' + file)
+
     # Imports files.
     data = lu.read_locs(file)
-    yaml_in = file.rstrip('hdf5') + 'yaml'
+    yaml_in = os.path.splitext(file)[0] + '.yaml'
     frame_val, height_val, width_val = lu.read_yaml(yaml_in)
 
     # Applies DBSCAN.
-    out_data = dbscan_locs(data, pixel_size, epsilon, min_sample, threshold)
+    out_data = dbscan_locs(data, pixel_size, epsilon, min_sample, threshold, n_jobs)
 
     # Shuffles dbscan ids. This helps to assign different colors to spatially close segments
     # when segments are visualized with Picasso Render.
-    unique_ids = out_data['dbscan'].unique().tolist()
-    unique_ids_random = random.sample(range(len(unique_ids)), len(unique_ids))
-    convert_id = dict(zip(unique_ids, unique_ids_random))
-    out_data['dbscan'] = [convert_id[i] for i in out_data['hdbscan']]
+    # The new ids are gathered from a lookup array indexed by the old (non-negative) ids.
+    # Seeds per file so the shuffle does not depend on which worker processes the file.
+    ids = out_data['dbscan'].to_numpy()
+    unique_ids = np.unique(ids)
+    unique_ids_random = random.Random(0).sample(range(len(unique_ids)), len(unique_ids))
+    convert_id = np.zeros(unique_ids.max() + 1 if len(unique_ids) else 0, dtype=np.int64)
+    convert_id[unique_ids] = unique_ids_random
+    out_data['dbscan'] = convert_id[ids]
 
     # Makes a directory for output.
     wd_path = os.path.dirname(file)
@@ -144,7 +155,8 @@ def dbscan_locs(locs_data: pd.DataFrame,
                 pixel_size: float,
                 epsilon: float,
                 min_sample: int,
-                threshold: int
+                threshold: int,
+                n_jobs: int = -1
                 ):
     """
     Apply the DBSCAN algorithm to 3D DNA-PAINT localization data.
@@ -153,6 +165,7 @@ def dbscan_locs(locs_data: pd.DataFrame,
     ----------
     locs_data : pd.DataFrame
         Localization data of 3D DNA-PAINT, should have 'z' column.
+        Modified in place: the 'dbscan' column is added to it.
     pixel_size : float
         Camera pixel size (nm).
     epsilon : float
@@ -161,6 +174,8 @@ def dbscan_locs(locs_data: pd.DataFrame,
         The desired minimum cluster size.
     threshold : int
         Cutoff of the cluster size after segmentation.
+    n_jobs : int, optional
+        Number of cores used by DBSCAN neighbor queries, default = -1 (all cores).
 
     Returns
     -------
@@ -176,33 +191,29 @@ def dbscan_locs(locs_data: pd.DataFrame,
     ]
     
     # Sets DBSCAN parameters.
-    clusterer = DBSCAN(eps=epsilon, min_samples=min_sample)
-    
-    data = locs_data.copy()
+    clusterer = DBSCAN(eps=epsilon, min_samples=min_sample, n_jobs=n_jobs)
     
     # Converts data_xyz to numpy.array.
-    xyz = lu.hdf2xyz(data, pixel_size)
+    xyz = lu.hdf2xyz(locs_data, pixel_size)
     
     # Applies DBSCAN.
     clusterer.fit(xyz)
     labels = clusterer.labels_
     
-    # Merges the DBSCAN labels into the original DataFrame.
-    data['dbscan'] = pd.Series(labels)
-    data = data[data_col]
+    # Adds the DBSCAN labels to the input DataFrame, row by row.
+    locs_data['dbscan'] = labels.astype(np.int32)
+    data = locs_data[data_col]
     
     # Drops 'noise' localizations.
     # Localizations which don't belong to clusters are labeled '-1'
-    data = data[data.dbscan != -1]
+    keep = data.dbscan != -1
     
     # Drops clusters with locs below the threshold.
     if threshold > 0:
-        dbscan_ids = data.dbscan.unique()
-        for id_ in dbscan_ids:
-            if len(data[data.dbscan == id_]) < threshold:
-                data = data[data.dbscan != id_]
+        cluster_sizes = data.groupby('dbscan')['dbscan'].transform('size')
+        keep &= cluster_sizes >= threshold
     
-    return data
+    return data[keep]
 
 
 if __name__ == '__main__':
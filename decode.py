@@ -5,6 +5,7 @@ SCRIPT_NAME = 'decode.py'
 VERSION = 1.0
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import os
 import numpy as np
@@ -18,6 +19,9 @@ binary mask file (tiff). Optionally takes in DAPI mask and other parameters.
 Returns decoded DNA-PAINT localization file(s).
 """ % (SCRIPT_NAME, VERSION)
 
+# Number of localizations gathered from the masks per thread task.
+GATHER_CHUNK = 1 << 18
+
 
 def main():
     """
@@ -91,7 +95,10 @@ def decode_paint(locs_file: str, mask_file: str, dapi_file=None, out_name=None,
     data = lu.read_locs(locs_file)
     masks = read_masks(mask_file)
     
-    yaml_in = locs_file.rstrip('hdf5') + 'yaml'
+    # Casts xy to pixel indices once for both the nucleus filter and the decoding
+    data = lu.cam_pixelize(data)
+    
+    yaml_in = os.path.splitext(locs_file)[0] + '.yaml'
     frame_val, height_val, width_val = lu.read_yaml(yaml_in)
     
     # Filters out clusters outside nucleus based on DAPI signal if specified
@@ -121,14 +128,14 @@ def decode_paint(locs_file: str, mask_file: str, dapi_file=None, out_name=None,
     
     # Decodes clusters
     decoded = decode_clusters(data, masks, cluster_col)
-    decoded.dropna(inplace=True)
+    decoded = decoded.drop(columns=['x_px', 'y_px']).dropna()
     
     # Outputs decoded files
     lu.write_locs(decoded, out_hdf5_name)
     lu.write_yaml(frame_val, height_val, width_val, out_yaml_name)
 
 
-def read_masks(im_stack: str) -> list:
+def read_masks(im_stack: str) -> np.ndarray:
     """
     Parameters
     ----------
@@ -137,55 +144,14 @@ def read_masks(im_stack: str) -> list:
 
     Returns
     -------
-    masks : list of np.array
-        8-bit SABER pre-decoding image stack
+    masks : np.ndarray
+        8-bit SABER pre-decoding image stack, shape (slices, height, width)
 
     """
     im = Image.open(im_stack)
-    masks = []
-    for i, page in enumerate(ImageSequence.Iterator(im)):
-        masks.append(np.array(page))
-    
-    return masks
-
-
-def get_mask_val(masks: list, slice: int, coordinate: tuple) -> int:
-    """
-    Parameters
-    ----------
-    masks : list
-    slice : int
-    coordinate : tuple
-
-    Returns
-    -------
-    the pixel intensity : int
-
-    """
-    mask = masks[slice]
-    
-    return get_pixel_val(mask, coordinate)
-
-
-def get_pixel_val(image: np.array, coordinate: tuple) -> int:
-    """
-    Parameters
-    ----------
-    image : np.array
-    coordinate : tuple
-
-    Returns
-    -------
-    the pixel intensity : int
-
-    """
     
-    try:
-        return image[coordinate[1], coordinate[0]]
-    
-    except IndexError:
-        print(f'Out of bounds: {coordinate}')
-        return 0
+    # Stacks all slices into one contiguous uint8 buffer so masks[:, y, x] gathers across slices.
+    return np.stack([np.asarray(page, dtype=np.uint8) for page in ImageSequence.Iterator(im)], axis=0)
 
 
 def filter_clusters(locs: pd.DataFrame, nucl_mask: np.array, cluster_col: str) -> pd.DataFrame:
@@ -195,6 +161,7 @@ def filter_clusters(locs: pd.DataFrame, nucl_mask: np.array, cluster_col: str) -
     Parameters
     ----------
     locs : pd.DataFrame
+        Should contain the 'x_px' and 'y_px' columns (see lu.cam_pixelize).
     nucl_mask : np.array
     cluster_col : str
 
@@ -203,48 +170,38 @@ def filter_clusters(locs: pd.DataFrame, nucl_mask: np.array, cluster_col: str) -
     data without outside nucleus locs : pd.DataFrame
 
     """
-    process_start = time.time()
+    print('Filtering out clusters outside nucleus...')
     
-    out_locs = pd.DataFrame()
+    # Bounding box of each cluster in pixel indices.
+    bbox = locs.groupby(cluster_col).agg(min_x=('x_px', 'min'), max_x=('x_px', 'max'),
+                                         min_y=('y_px', 'min'), max_y=('y_px', 'max'))
+    corners = bbox.to_numpy()
     
-    print('Filtering out clusters outside nucleus...')
+    # Corners as (x, y) pairs: top left, top right, bottom left, bottom right.
+    xs = corners[:, [0, 1, 0, 1]]
+    ys = corners[:, [2, 2, 3, 3]]
+    
+    # Corners outside the mask count as background.
+    height, width = nucl_mask.shape[:2]
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    corner_vals = np.where(inside, nucl_mask[np.clip(ys, 0, height - 1), np.clip(xs, 0, width - 1)], 0)
     
-    unique_dbscan = len(locs[cluster_col].unique())
-    counter = 0
-    
-    for dbscan, locs_group in locs.groupby(cluster_col):
-        min_x = int(locs_group['x'].min())
-        max_x = int(locs_group['x'].max())
-        min_y = int(locs_group['y'].min())
-        max_y = int(locs_group['y'].max())
-        
-        top_left = get_pixel_val(nucl_mask, (min_x, min_y))
-        top_right = get_pixel_val(nucl_mask, (max_x, min_y))
-        bottom_left = get_pixel_val(nucl_mask, (min_x, max_y))
-        bottom_right = get_pixel_val(nucl_mask, (max_x, max_y))
-        
-        if top_left > 0 or top_right > 0 or bottom_left > 0 or bottom_right > 0:
-            out_locs = pd.concat([out_locs, locs_group], ignore_index=True)
-        
-        counter += 1
-        if counter % 1000 == 0 or counter == unique_dbscan:
-            elapsed_time = time.time() - process_start
-            print(f'DBSCAN processed: {counter}/{unique_dbscan},'
-                  f'process time: {elapsed_time} [sec]')
+    kept = bbox.index[(corner_vals > 0).any(axis=1)]
     
     print('Filtering done')
     
-    return out_locs
+    return locs[locs[cluster_col].isin(kept)].reset_index(drop=True)
 
 
-def decode_clusters(locs: pd.DataFrame, masks: list, cluster_col: str) -> pd.DataFrame:
+def decode_clusters(locs: pd.DataFrame, masks: np.ndarray, cluster_col: str) -> pd.DataFrame:
     """
     Returns decoded data.
     
     Parameters
     ----------
     locs : pd.DataFrame
-    masks : list
+        Should contain the 'x_px' and 'y_px' columns (see lu.cam_pixelize).
+    masks : np.ndarray
     cluster_col : str
 
     Returns
@@ -256,85 +213,88 @@ def decode_clusters(locs: pd.DataFrame, masks: list, cluster_col: str) -> pd.Dat
     process_start = time.time()
     print('Decoding clusters...')
     
-    out_locs = pd.DataFrame()
-    unique_clusters = len(locs[cluster_col].unique())
-    counter = 0
+    # Packs the binary masks 8 slices per byte, then sums the per-loc overlaps of each cluster
+    # in one grouped reduction.
+    packed_masks = np.packbits(masks > 0, axis=0)
+    overlap = pd.DataFrame(count_mask_overlap(locs, packed_masks, len(masks)), index=locs.index)
+    grouped = overlap.groupby(locs[cluster_col])
+    cluster_overlap = grouped.sum()
     
-    for _, locs_group in locs.groupby(cluster_col):
-        
-        locs_group['id'] = decode_ids(locs_group, masks)
-        out_locs = pd.concat([out_locs, locs_group], ignore_index=True)
-        
-        counter += 1
-        if counter % 1000 == 0 or counter == unique_clusters:
-            print(f'DBSCAN decoded: {counter}/{unique_clusters},'
-                  f'Process time: {time.time() - process_start} [sec]')
+    decoded_ids = decode_ids(cluster_overlap.to_numpy(), grouped.size().to_numpy())
     
-    return out_locs
+    decoded = locs.assign(id=locs[cluster_col].map(pd.Series(decoded_ids, index=cluster_overlap.index)))
+    
+    print(f'DBSCAN decoded: {len(cluster_overlap)}, '
+          f'Process time: {time.time() - process_start} [sec]')
+    
+    return decoded.reset_index(drop=True)
 
 
-def decode_ids(cluster: pd.DataFrame, masks: list):
+def decode_ids(mask_overlap: np.ndarray, total_locs: np.ndarray) -> np.ndarray:
     """
-    Decodes a h/dbscaned cluster based on overlap scores.
+    Decodes h/dbscaned clusters based on overlap scores.
     
     Parameters
     ----------
-    cluster : pd.DataFrame
-    masks : list
+    mask_overlap : np.ndarray
+        Number of locs overlapped with each mask, shape (clusters, masks).
+    total_locs : np.ndarray
+        Number of locs in each cluster.
 
     Returns
     -------
-    decoded : int or np.nan
+    decoded : np.ndarray
+        Mask index of each cluster, -1 for ties or np.nan if rejected.
 
     """
-    # Input form: a group of locs sharing with the same 'h/dbscan' id
-    mask_overlap = count_mask_overlap(cluster, masks)
-    half_total_locs = len(cluster) / 2
+    max_overlap = mask_overlap.max(axis=1)
+    is_tie = (mask_overlap == max_overlap[:, None]).sum(axis=1) > 1
     
-    if mask_overlap.max() == 0: # Rejects if no overlap
-        return np.nan
+    decoded = np.where(is_tie, -1, mask_overlap.argmax(axis=1)).astype(np.float64)
     
-    elif mask_overlap.max() < half_total_locs: # Rejects if no more than 50% overlap
-        return np.nan
+    # Rejects if no overlap or no more than 50% overlap.
+    decoded[(max_overlap == 0) | (max_overlap < total_locs / 2)] = np.nan
     
-    else:
-        max_index = [i for i, x in enumerate(mask_overlap) if x == max(mask_overlap)]
-        if len(max_index) == 1:
-            return max_index[0] # Assigns id with
-        else:
-            return -1
+    return decoded
 
 
-def count_mask_overlap(cluster: pd.DataFrame, masks: list) -> int:
+def count_mask_overlap(locs: pd.DataFrame, packed_masks: np.ndarray, n_masks: int) -> np.ndarray:
     """
-    Counts the number of localizations overlapped with mask.
+    Scores the overlap of each localization with each mask.
     
     Parameters
     ----------
-    cluster : pd.DataFrame
-    masks : list
+    locs : pd.DataFrame
+        Should contain the 'x_px' and 'y_px' columns (see lu.cam_pixelize).
+    packed_masks : np.ndarray
+        Binary masks packed along the slice axis with np.packbits, shape (ceil(n_masks / 8), height, width).
+    n_masks : int
+        Number of mask slices before packing.
 
     Returns
     -------
-    number of locs overlapped with mask : int
+    overlap of each loc with each mask (1 or 0) : np.ndarray, shape (locs, masks)
 
     """
-    # Input form: locs which have the same 'dbscan' id
-    cluster = cluster[['x', 'y']].astype('uint32')
-    cluster['count'] = 1
-    
-    len_masks = len(masks)
-    mask_overlap = np.empty((0, len_masks), int)
-    
-    for key, selected in cluster.groupby(['x', 'y'], as_index=False):
-        out_row = []
-        for i in range(len_masks):
-            # divide by 255 as binary masks have either 0 or 255 (8-bit)
-            out_row.append(get_mask_val(masks, i, key) / 255 * len(selected))
-        
-        mask_overlap = np.append(mask_overlap, np.array([out_row]), axis=0)
-
-    return mask_overlap.sum(axis=0)
+    xs = locs['x_px'].to_numpy()
+    ys = locs['y_px'].to_numpy()
+    
+    # Locs outside the masks overlap with none of them.
+    inside = (xs >= 0) & (xs < packed_masks.shape[2]) & (ys >= 0) & (ys < packed_masks.shape[1])
+    
+    overlap = np.zeros((len(locs), n_masks), dtype=np.uint8)
+    
+    def gather(rows: np.ndarray) -> None:
+        # Gathers one byte per 8 slices and unpacks it into one 0/1 lane per slice.
+        packed = packed_masks[:, ys[rows], xs[rows]]
+        overlap[rows] = np.unpackbits(packed, axis=0, count=n_masks).T
+    
+    # Gathers row chunks on threads; NumPy releases the GIL while indexing and unpacking.
+    rows = np.flatnonzero(inside)
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(gather, np.array_split(rows, max(1, len(rows) // GATHER_CHUNK))))
+    
+    return overlap
     
 
 if __name__ == '__main__':
@@ -7,8 +7,10 @@ VERSION = 1.0
 from glob import glob
 import argparse
 import os
+import numpy as np
 import pandas as pd
 from hdbscan import HDBSCAN
+from joblib import Memory
 import locsutil as lu
 import time
 import random
@@ -122,7 +124,7 @@ def find_cluster(locs_file: str,
     
     # Imports files.
     data = lu.read_locs(locs_file)
-    yaml_in = locs_file.rstrip('hdf5') + 'yaml'
+    yaml_in = os.path.splitext(locs_file)[0] + '.yaml'
     frame_val, height_val, width_val = lu.read_yaml(yaml_in)
     
     # Applies HDBSCAN.
@@ -130,11 +132,10 @@ def find_cluster(locs_file: str,
     
     # Shuffles hdbscan ids. This helps to assign different colors to spatially close segments
     # when segments are visualized with Picasso Render.
-    unique_ids = out_data['hdbscan'].unique().tolist()
-    random.seed(0)  # Fixes random seed.
-    unique_ids_randomized = random.sample(unique_ids, len(unique_ids))
-    new_ids = dict(zip(unique_ids, unique_ids_randomized))
-    out_data['hdbscan'] = [new_ids[i] for i in out_data['hdbscan']]
+    # The new ids are gathered by the position of each old id in order of appearance.
+    codes, unique_ids = pd.factorize(out_data['hdbscan'].to_numpy())
+    unique_ids_randomized = random.Random(0).sample(unique_ids.tolist(), len(unique_ids))  # Fixes random seed.
+    out_data['hdbscan'] = np.asarray(unique_ids_randomized, dtype=np.int32)[codes]
     
     # Makes an output directory.
     work_dir = os.path.dirname(locs_file)
@@ -168,6 +169,7 @@ def hdbscan_locs(locs_data: pd.DataFrame,
     ----------
     locs_data : pd.DataFrame
         Localization data of 3D DNA-PAINT, should have 'z' column.
+        Modified in place: the 'hdbscan' and 'hdbscan_prob' columns are added to it.
     pixel_size : float
         Camera pixel size (nm).
     min_cluster_size : int
@@ -202,6 +204,57 @@ def hdbscan_locs(locs_data: pd.DataFrame,
         'd_zcalib', 'hdbscan'
     ]
     
+    # Converts xyz coordinates to numpy.array
+    xyz = lu.hdf2xyz(locs_data, pixel_size)
+    
+    # Applies HDBSCAN. With a caching directory, the labels are cached by a hash of xyz and the parameters.
+    if memory is not None:
+        labels, prob = Memory(memory, verbose=0).cache(fit_hdbscan, ignore=['memory'])(
+            xyz, min_cluster_size, min_samples, cluster_selection_epsilon, memory)
+    else:
+        labels, prob = fit_hdbscan(xyz, min_cluster_size, min_samples, cluster_selection_epsilon)
+    
+    # Adds the HDBSCAN labels to the input DataFrame, row by row
+    locs_data['hdbscan'] = labels.astype(np.int32)
+    locs_data['hdbscan_prob'] = prob.astype(np.float32)
+    
+    # Checks if locs_data is linked
+    if 'len' in locs_data.columns:
+        data = locs_data[data_col_linked]
+    else:
+        data = locs_data[data_col_unlinked]
+    
+    # Drops 'noise' localizations
+    data = data[data.hdbscan > -1]
+    
+    return data
+
+
+def fit_hdbscan(xyz: np.ndarray,
+                min_cluster_size: int,
+                min_samples: int,
+                cluster_selection_epsilon: float,
+                memory: str = None,
+                ) -> tuple:
+    """
+    Fits HDBSCAN to xyz coordinates and returns the cluster labels and their probabilities.
+    
+    Parameters
+    ----------
+    xyz : np.ndarray
+    min_cluster_size : int
+    min_samples : int
+    cluster_selection_epsilon : float
+    memory : str, optional
+        A path to the caching directory of the HDBSCAN tree if a string is given.
+
+    Returns
+    -------
+    labels : np.ndarray
+    prob : np.ndarray
+
+    """
+    
     # Sets HDBSCAN parameters
     if memory is not None:
         clusterer = HDBSCAN(min_cluster_size=min_cluster_size,
@@ -213,30 +266,9 @@ def hdbscan_locs(locs_data: pd.DataFrame,
                             min_samples=min_samples,
                             cluster_selection_epsilon=cluster_selection_epsilon)
     
-    data = locs_data.copy()
-    
-    # Converts xyz coordinates to numpy.array
-    xyz = lu.hdf2xyz(data, pixel_size)
-    
-    # Applies HDBSCAN
     clusterer.fit(xyz)
-    labels = clusterer.labels_
-    prob = clusterer.probabilities_
-    
-    # Merges the DBSCAN labels into the original DataFrame
-    data['hdbscan'] = pd.Series(labels)
-    data['hdbscan_prob'] = pd.Series(prob)
-    
-    # Checks if locs_data is linked
-    if 'len' in data.columns:
-        data = data[data_col_linked]
-    else:
-        data = data[data_col_unlinked]
     
-    # Drops 'noise' localizations
-    data = data[data.hdbscan > -1]
-    
-    return data
+    return clusterer.labels_, clusterer.probabilities_
 
 
 if __name__ == '__main__':
@@ -7,26 +7,49 @@ VERSION = 1.0
 import pandas as pd
 import h5py
 import re
+import os
+from functools import lru_cache
 import numpy as np
 
 
 # Toolbox to handle localization files and SABER masks for Decode-PAINT.
 
+# Column types of Picasso localization files. Columns are narrowed to these types on import
+# so that masks and arithmetic run on 32-bit data.
+LOCS_DTYPES = {
+    'frame': 'uint32', 'x': 'float32', 'y': 'float32', 'photons': 'float32',
+    'sx': 'float32', 'sy': 'float32', 'bg': 'float32', 'lpx': 'float32', 'lpy': 'float32',
+    'ellipticity': 'float32', 'net_gradient': 'float32', 'z': 'float32', 'd_zcalib': 'float32',
+    'len': 'uint32', 'n': 'uint32', 'photon_rate': 'float32',
+    'dbscan': 'int32', 'hdbscan': 'int32', 'hdbscan_prob': 'float32', 'id': 'float32'
+}
 
-def get_hdf_list() -> list:
+# Column types written to Picasso localization files; other columns are written as float32.
+WRITE_DTYPES = {'frame': 'uint32', 'len': 'uint32', 'n': 'uint32', 'dbscan': 'uint32', 'hdbscan': 'uint32'}
+
+# Keywords removed from file names by clean_filename, matched in a single pass.
+CLEAN_FILENAME_RE = re.compile(r'_render|_arender|_linked|_filtered|_cropped|_corrected|_dbscan.*|\.hdf5$|\.yaml$')
+
+
+def get_hdf_list(directory: str = '') -> list:
     """
     Finds all HDF5 files in the directory and returns a list of them.
     
+    Parameters
+    ----------
+    directory : str, optional
+        Directory to search, default = '' (the working directory).
+
     Returns
     -------
     list
-        List of .hdf5 files found in the directory, sorted.
+        List of .hdf5 files found in the directory, sorted, prefixed with the directory.
 
     """
     
     from glob import glob
     
-    return sorted(glob('*.hdf5'))
+    return sorted(glob(os.path.join(directory, '*.hdf5')))
 
 
 def read_locs(locs_file: str) -> pd.DataFrame:
@@ -45,13 +68,41 @@ def read_locs(locs_file: str) -> pd.DataFrame:
 
     """
     
-    # Reads DNA-PAINT localization file
-    data = pd.read_hdf(locs_file, key='locs', ignore_index=True)
+    # Reads the compound 'locs' dataset directly with h5py, already sorted and narrowed
+    return pd.DataFrame(read_locs_soa(locs_file), copy=False)
+
+
+def read_locs_soa(locs_file: str) -> dict:
+    """
+    Reads a Picasso-format DNA-PAINT localization file and returns each column as np.array.
     
-    data = data.sort_values(by=['frame'])
-    data = data.reset_index(drop=True)
+    Parameters
+    ----------
+    locs_file : str
+        Path to DNA-PAINT localization file (HDF5 format).
+
+    Returns
+    -------
+    data : dict of np.array
+        Localization data sorted by 'frame', keyed by column name.
+
+    """
+    
+    # Reads the compound 'locs' dataset as a structured array, with a 64 MB chunk cache
+    with h5py.File(locs_file, 'r', rdcc_nbytes=64 * 1024 * 1024) as f:
+        dataset = f['locs']
+        
+        # Reads row-chunked files straight into one preallocated buffer
+        if dataset.chunks == (1,):
+            rec_data = np.empty(dataset.shape, dtype=dataset.dtype)
+            dataset.read_direct(rec_data)
+        else:
+            rec_data = dataset[()]
     
-    return data
+    order = np.argsort(rec_data['frame'], kind='stable')
+    
+    return {name: rec_data[name][order].astype(LOCS_DTYPES.get(name, rec_data.dtype[name]), copy=False)
+            for name in rec_data.dtype.names}
 
 
 def write_locs(locs_data: pd.DataFrame, out_path: str) -> None:
@@ -69,34 +120,64 @@ def write_locs(locs_data: pd.DataFrame, out_path: str) -> None:
 
     """
     
-    data_out = locs_data.copy()
+    write_locs_records(to_locs_records(locs_data), out_path)
+
+
+def to_locs_records(locs_data: pd.DataFrame) -> np.ndarray:
+    """
+    Converts localization data to a record array in the Picasso column types.
     
-    # Converts to original types
-    data_out['frame'] = data_out['frame'].astype('uint32')
-    data_out[data_out.columns[1:]] \
-        = data_out[data_out.columns[1:]].astype('float32')
+    Parameters
+    ----------
+    locs_data : pd.DataFrame
+
+    Returns
+    -------
+    rec_data : np.ndarray
+
+    """
     
-    if 'len' in data_out.columns:
-        data_out['len'] = data_out['len'].astype('uint32')
-    if 'n' in data_out.columns:
-        data_out['n'] = data_out['n'].astype('uint32')
-    if 'dbscan' in data_out.columns:
-        data_out['dbscan'] = data_out['dbscan'].astype('uint32')
-    if 'hdbscan' in data_out.columns:
-        data_out['hdbscan'] = data_out['hdbscan'].astype('uint32')
+    # Builds the record array in the original types directly from the column arrays.
+    rec_data = np.empty(len(locs_data), dtype=[(col, WRITE_DTYPES.get(col, 'float32'))
+                                               for col in locs_data.columns])
     
-    # Converts data for export
-    rec_data = data_out.to_records(index=False)
+    for col in locs_data.columns:
+        rec_data[col] = locs_data[col].to_numpy()
+    
+    return rec_data
+
+
+def write_locs_records(rec_data: np.ndarray, out_path: str) -> None:
+    """
+    Writes a record array from to_locs_records as a Picasso-format DNA-PAINT localization file.
+    
+    Parameters
+    ----------
+    rec_data : np.ndarray
+    out_path : str
+
+    Returns
+    -------
+    None
+
+    """
     
-    # Writes to hdf5 file
+    # Writes to hdf5 file, chunked by rows and LZF-compressed (built into h5py).
+    # An empty dataset cannot be chunked, so it is written as is.
     with h5py.File(out_path, 'w') as locs_file:
-        locs_file.create_dataset('locs', data=rec_data)
+        if len(rec_data) == 0:
+            locs_file.create_dataset('locs', data=rec_data)
+        else:
+            locs_file.create_dataset('locs', data=rec_data, chunks=(min(len(rec_data), 65536),),
+                                     compression='lzf', shuffle=True)
 
 
+@lru_cache(maxsize=None)
 def read_yaml(yaml_file: str) -> None:
     """
     Reads a YAML file associated with a Picasso-format DNA-PAINT
     localization file and returns its information.
+    Results are cached per path, so a YAML file shared across a series is parsed once.
     
     Parameters
     ----------
@@ -111,21 +192,18 @@ def read_yaml(yaml_file: str) -> None:
 
     """
     
+    # Splits each 'key: value' row once; later rows overwrite earlier ones.
+    fields = {}
     with open(yaml_file) as f:
-        contents = f.readlines()
-    
-    for row in contents:
-        if row.split(':')[0] == 'Frames':
-            frames = row.split(':')[1].strip()
-        elif row.split(':')[0] == 'Height':
-            height = row.split(':')[1].strip()
-        elif row.split(':')[0] == 'Width':
-            width = row.split(':')[1].strip()
+        for row in f:
+            key, sep, value = row.partition(':')
+            if sep:
+                fields[key] = value.strip()
     
     try:
-        return frames, height, width
+        return fields['Frames'], fields['Height'], fields['Width']
     
-    except UnboundLocalError:
+    except KeyError:
         print('At least one of the image details is missing in in the YAML file.')
 
 
@@ -185,30 +263,37 @@ def clean_locs(locs_data: pd.DataFrame,
     -------
     data_out : pd.DataFrame
         Localization data of 3D DNA-PAINT, cleaned.
+        The input itself is returned if no localization is filtered out.
 
     """
     
-    data_out = locs_data.copy()
+    # ANDs all enabled conditions into one mask and slices the data once.
+    keep = np.ones(len(locs_data), dtype=bool)
     
     if max_dzcalib != 0:
-        data_out = data_out[data_out['d_zcalib'] <= max_dzcalib]
+        keep &= locs_data['d_zcalib'].to_numpy() <= max_dzcalib
     
     if max_lp != 0:
-        data_out = data_out[data_out['lpx'] <= max_lp]
-        data_out = data_out[data_out['lpy'] <= max_lp]
+        keep &= locs_data['lpx'].to_numpy() <= max_lp
+        keep &= locs_data['lpy'].to_numpy() <= max_lp
     
     if min_z != -9999.9:
-        data_out = data_out[data_out['z'] >= min_z]
+        keep &= locs_data['z'].to_numpy() >= min_z
     
     if max_z != 9999.9:
-        data_out = data_out[data_out['z'] <= max_z]
+        keep &= locs_data['z'].to_numpy() <= max_z
     
     if max_photon != -1:
-        data_out = data_out[data_out['photons'] <= max_photon]
+        keep &= locs_data['photons'].to_numpy() <= max_photon
     
-    return data_out
+    # Skips the copy when every condition is disabled or nothing fails.
+    if keep.all():
+        return locs_data
+    
+    return locs_data[keep]
 
 
+@lru_cache(maxsize=4096)
 def clean_filename(file_name: str) -> str:
     """
     Removes some keywords from a file name.
@@ -222,17 +307,8 @@ def clean_filename(file_name: str) -> str:
     new_name : str
 
     """
-    new_name = file_name.replace('_render', '')
-    new_name = new_name.replace('_arender', '')
-    new_name = new_name.replace('_linked', '')
-    new_name = new_name.replace('_filtered', '')
-    new_name = new_name.replace('_cropped', '')
-    new_name = new_name.replace('_corrected', '')
-    new_name = new_name.replace('.hdf5', '')
-    new_name = new_name.replace('.yaml', '')
-    new_name = re.sub('_dbscan.*', '', new_name)
     
-    return new_name
+    return CLEAN_FILENAME_RE.sub('', file_name)
 
 
 def hdf2xyz(locs_data: pd.DataFrame, pixel_size: float) -> np.array:
@@ -248,15 +324,14 @@ def hdf2xyz(locs_data: pd.DataFrame, pixel_size: float) -> np.array:
 
     Returns
     -------
-    data[['new_x', 'new_y', 'z']].to_numpy() : numpy.array
-    
+    xyz : numpy.array
+        (N, 3) array of x and y in nm and z.
 
     """
-    data = locs_data.copy()
-    data['new_x'] = data['x'].astype('float') * pixel_size
-    data['new_y'] = data['y'].astype('float') * pixel_size
     
-    return data[['new_x', 'new_y', 'z']].to_numpy()
+    return np.column_stack((locs_data['x'].to_numpy(np.float64) * pixel_size,
+                            locs_data['y'].to_numpy(np.float64) * pixel_size,
+                            locs_data['z'].to_numpy(np.float64)))
 
 
 def convert_xy(locs_data: pd.DataFrame, pixel_size: float) -> pd.DataFrame:
@@ -266,21 +341,23 @@ def convert_xy(locs_data: pd.DataFrame, pixel_size: float) -> pd.DataFrame:
     Parameters
     ----------
     locs_data : pd.DataFrame
+        Modified in place: the '_nm' columns are added to it.
     pixel_size
     
     Returns
     -------
     converted : pd.DataFrame
+        The input frame.
 
     """
-    converted = locs_data.copy()
+    converted = locs_data
+    
+    # Scales all pixel-unit columns in one float32 multiply
+    px_cols = ['x', 'y', 'sx', 'sy', 'lpx', 'lpy']
+    scaled = converted[px_cols].to_numpy(dtype=np.float32) * np.float32(pixel_size)
     
-    converted['x_nm'] = converted['x'] * pixel_size
-    converted['y_nm'] = converted['y'] * pixel_size
-    converted['sx_nm'] = converted['sx'] * pixel_size
-    converted['sy_nm'] = converted['sy'] * pixel_size
-    converted['lpx_nm'] = converted['lpx'] * pixel_size
-    converted['lpy_nm'] = converted['lpy'] * pixel_size
+    for i, col in enumerate(px_cols):
+        converted[f'{col}_nm'] = scaled[:, i]
     
     return converted
 
@@ -292,16 +369,18 @@ def voxelize(locs_data: pd.DataFrame, bin_xy: float, bin_z: float) -> pd.DataFra
     Parameters
     ----------
     locs_data : pd.DataFrame
+        Modified in place: the '_vox' columns are added to it.
     bin_xy : float
     bin_z : float
 
     Returns
     -------
     voxelized : pd.DataFrame
+        The input frame.
     
     """
     
-    voxelized = locs_data.copy()
+    voxelized = locs_data
     
     voxelized['x_vox'] = (voxelized['x_nm'] // bin_xy)
     voxelized['y_vox'] = (voxelized['y_nm'] // bin_xy)
@@ -321,17 +400,18 @@ def cam_pixelize(locs_data: pd.DataFrame) -> pd.DataFrame:
     Returns
     -------
     locs_data : pd.DataFrame
+        The input frame, the int32 'x_px' and 'y_px' columns added.
 
     """
-    locs_data['x_px'] = locs_data['x'].astype(int)
-    locs_data['y_px'] = locs_data['y'].astype(int)
+    locs_data['x_px'] = locs_data['x'].to_numpy().astype(np.int32)
+    locs_data['y_px'] = locs_data['y'].to_numpy().astype(np.int32)
     
     return locs_data
 
 
 def get_status(file_base: str) -> str:
 
-    file_info = file_base.strip('.hdf5').split('_')
+    file_info = os.path.splitext(file_base)[0].split('_')
 
     if 'xa' in file_info:
         status = 'active'
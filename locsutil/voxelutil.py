@@ -29,15 +29,13 @@ def extract_core(df):
     return df[df['total_faces'] == 0]
 
 
-def count_exposed_faces(locs_group: pd.DataFrame):
+def count_exposed_faces(vox: np.ndarray):
+    # vox: (N, 3) array of voxel indices (x_vox, y_vox, z_vox), one row per localization.
     
-    locs_group = locs_group[~locs_group.duplicated(
-        subset=['x_vox', 'y_vox', 'z_vox'])]
+    keys, dims = pack_voxels(vox)
+    keys = np.unique(keys)
     
-    locs_group = locs_group[['x_vox', 'y_vox', 'z_vox']].astype('int')
-    locs_group = auto_origin_df(locs_group)
-    
-    out_data = scan_faces_all(locs_group)
+    out_data = scan_faces_all(keys, dims)
     out_data['xy_faces'] = out_data['x_faces'] + out_data['y_faces']
     out_data['total_faces'] = out_data['x_faces'] + \
                               out_data['y_faces'] + out_data['z_faces']
@@ -50,69 +48,115 @@ def count_exposed_faces(locs_group: pd.DataFrame):
     return out_data, total_vox, surf_vox, xy_faces, z_faces
 
 
-def scan_faces_all(df: pd.DataFrame) -> pd.DataFrame:
+def count_exposed_faces_grouped(groups: np.ndarray, vox: np.ndarray, n_groups: int):
+    """
+    Counts the voxels and exposed faces of several voxel sets at once.
     
-    scanned = scan_faces(df, 'x_vox')
-    scanned = scan_faces(scanned, 'y_vox')
-    scanned = scan_faces(scanned, 'z_vox')
+    Parameters
+    ----------
+    groups : np.ndarray
+        (N,) set index of each localization, 0 to n_groups - 1.
+    vox : np.ndarray
+        (N, 3) array of voxel indices (x_vox, y_vox, z_vox), one row per localization.
+    n_groups : int
+
+    Returns
+    -------
+    total_vox, surf_vox, xy_faces, z_faces : np.ndarray
+        One value per set.
     
-    return scanned
+    """
+    
+    keys, dims = pack_voxels(vox)
+    
+    # Offsets the keys of each set by a whole padded grid, so that sets never share a face neighbor.
+    grid_size = dims.prod()
+    keys = np.unique(np.asarray(groups, dtype=np.int64) * grid_size + keys)
+    key_groups = keys // grid_size
+    
+    x_faces = scan_faces(keys, dims[1] * dims[2])
+    y_faces = scan_faces(keys, dims[2])
+    z_faces = scan_faces(keys, 1)
+    is_surf = (x_faces + y_faces + z_faces) != 0
+    
+    total_vox = np.bincount(key_groups, minlength=n_groups)
+    surf_vox = np.bincount(key_groups, weights=is_surf, minlength=n_groups).astype(np.int64)
+    xy_faces = np.bincount(key_groups, weights=x_faces + y_faces, minlength=n_groups).astype(np.int64)
+    z_faces = np.bincount(key_groups, weights=z_faces, minlength=n_groups).astype(np.int64)
+    
+    return total_vox, surf_vox, xy_faces, z_faces
 
 
-def scan_faces(df: pd.DataFrame, axis: str) -> pd.DataFrame:
+def pack_voxels(vox: np.ndarray):
+    """
+    Packs (x_vox, y_vox, z_vox) of each voxel into a single int64 key.
+    The origin is moved to (1, 1, 1) so that every face neighbor also has a valid key.
+    
+    Returns
+    -------
+    keys : np.ndarray
+    dims : np.ndarray
+        Extent of the padded grid along x, y, and z.
+    
+    """
+    
+    # Keeps integer voxel indices in their own dtype (e.g. int32); only the keys are widened to int64
+    vox = np.asarray(vox)
+    if vox.dtype.kind not in 'iu':
+        vox = vox.astype(np.int64)
     
-    if axis == 'x_vox':
-        fixed_columns = ['y_vox', 'z_vox']
-        diff_col = 'x_diff'
-        face_col = 'x_faces'
-    elif axis == 'y_vox':
-        fixed_columns = ['x_vox', 'z_vox']
-        diff_col = 'y_diff'
-        face_col = 'y_faces'
-    else:
-        fixed_columns = ['x_vox', 'y_vox']
-        diff_col = 'z_diff'
-        face_col = 'z_faces'
+    vox = vox - (vox.min(axis=0) - 1)
+    dims = vox.max(axis=0).astype(np.int64) + 2
     
-    return scan_faces_1d(df, axis, fixed_columns, diff_col, face_col)
+    keys = (vox[:, 0].astype(np.int64) * dims[1] + vox[:, 1]) * dims[2] + vox[:, 2]
+    
+    return keys, dims
 
 
-def scan_faces_1d(df: pd.DataFrame, axis: str, fixed_columns: list, diff_col: str, face_col: str) -> pd.DataFrame:
-    """
-    Scans the volume in the one-dimensional manner to determine if the two faces of a voxel
-    facing each other are exposed or not.
-    E.g. fixed_columns = ['y_vox', 'z_vox']
-    Scans each yz-fixed column: (n, 0, 0), (n, 1, 0), (n, 2, 0), etc...
+def unpack_voxels(keys: np.ndarray, dims: np.ndarray) -> np.ndarray:
+    
+    x_vox, rest = np.divmod(keys, dims[1] * dims[2])
+    y_vox, z_vox = np.divmod(rest, dims[2])
+    
+    return np.column_stack((x_vox, y_vox, z_vox))
 
+
+def scan_faces_all(keys: np.ndarray, dims: np.ndarray) -> pd.DataFrame:
+    """
+    Counts the exposed faces of each voxel along x, y, and z.
+    keys should be the sorted, unique keys of pack_voxels.
+    
     """
     
-    scanned = pd.DataFrame()
-    
-    for _, locs_group in df.groupby(fixed_columns, as_index=False):
-        # Selects a column of voxels.
-        
-        locs_group.sort_values(by=axis, inplace=True)  # axis = 'x_vox': sorts in order of the x_vox values
-        locs_group.reset_index(drop=True, inplace=True)
-        locs_group[face_col] = 0  # face_col = 'x_faces': 0 = not exposed, 1 or 2 = exposed
-        
-        locs_group[diff_col] = locs_group[axis].diff()  # diff_col = 'x_diff': checks the continuity, 1 = continuous
-        locs_group[diff_col].fillna(0, inplace=True)
-        
-        for index, row in locs_group.iterrows():
-            if index == 0:
-                locs_group.at[index, face_col] = 1  # The first face is always exposed
-            if locs_group.at[index, diff_col] > 1:  # If the two voxels are not neighbors
-                locs_group.at[index - 1, face_col] += 1
-                locs_group.at[index, face_col] += 1
-            if index == len(locs_group) - 1:
-                locs_group.at[index, face_col] += 1  # The last face is always exposed
-        
-        scanned = pd.concat([scanned, locs_group], ignore_index=True)
-        scanned.drop(columns=[diff_col], inplace=True)
+    scanned = pd.DataFrame(unpack_voxels(keys, dims), columns=['x_vox', 'y_vox', 'z_vox'])
+    
+    # Neighbors along x, y, and z are one stride away in the packed keys.
+    scanned['x_faces'] = scan_faces(keys, dims[1] * dims[2])
+    scanned['y_faces'] = scan_faces(keys, dims[2])
+    scanned['z_faces'] = scan_faces(keys, 1)
     
     return scanned
 
 
+def scan_faces(keys: np.ndarray, stride: int) -> np.ndarray:
+    """
+    Determines if the two faces of each voxel along one axis are exposed or not,
+    i.e. if there is no voxel at key - stride or key + stride.
+    Returns 0 = not exposed, 1 or 2 = exposed.
+    
+    """
+    
+    return (~contains(keys, keys - stride)).astype(np.int64) + ~contains(keys, keys + stride)
+
+
+def contains(keys: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    # Checks membership of each query in the sorted keys.
+    
+    index = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    
+    return keys[index] == queries
+
+
 def auto_origin_df(df: pd.DataFrame) -> pd.DataFrame:
     
     df['x_vox'] = df['x_vox'] - df['x_vox'].min() + 1
@@ -6,7 +6,13 @@ VERSION = 1.0
 
 from glob import glob
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
 import locsutil as lu
 import time
@@ -14,7 +20,7 @@ import time
 MESSAGE = f"""
 %s version %s. Requires a path to DNA-PAINT localization file (HDF5) or a directory containing
 localization files. Optionally takes in other parameters.
-Returns SRX compatible CSV files.
+Returns SRX compatible CSV files (or Parquet files with the same columns).
 """ % (SCRIPT_NAME, VERSION)
 
 # SRX .csv file format
@@ -39,6 +45,7 @@ def main():
     pixel : int, optional
     segmented : bool, optional
     decoded : bool, optional
+    format : str, optional
     
     Returns
     -------
@@ -63,6 +70,8 @@ def main():
                         default=False, help='Whether file was segmented. Default = disabled.')
     user_input.add_argument('-d', '--decoded', action='store_true',
                         default=False, help='Whether file was decoded. Default = disabled.')
+    user_input.add_argument('-t', '--format', action='store', type=str, choices=['csv', 'parquet'],
+                        default='csv', help='Output file format. Default = csv.')
     
     args = user_input.parse_args()
     input_path = args.input
@@ -70,6 +79,7 @@ def main():
     frames_per_section = args.frames
     segmented = args.segmented
     decoded = args.decoded
+    out_format = args.format
     
     # Starts a timer.
     start = time.time()
@@ -78,11 +88,13 @@ def main():
     if os.path.isdir(input_path):
         query = os.path.join(input_path, '*.hdf5')
         locs_files = glob(query)
-        for file in locs_files:
-            print('Converting...' + file)
-            picasso_to_srx(file, pixel_size, frames_per_section, segmented, decoded)
+        
+        # Converts files in parallel, one process per file.
+        with ProcessPoolExecutor() as executor:
+            list(executor.map(picasso_to_srx, locs_files, repeat(pixel_size), repeat(frames_per_section),
+                              repeat(segmented), repeat(decoded), repeat(out_format)))
     else:
-        picasso_to_srx(input_path, pixel_size, frames_per_section, segmented, decoded)
+        picasso_to_srx(input_path, pixel_size, frames_per_section, segmented, decoded, out_format)
     
     print(f'Total_time: {time.time() - start} [sec]')
 
@@ -91,9 +103,12 @@ def picasso_to_srx(input_file: str,
                    pixel_size: float,
                    frames_per_section: int,
                    segmented: bool,
-                   decoded: bool
+                   decoded: bool,
+                   out_format: str = 'csv'
                    ) -> None:
     
+    print('Converting...' + input_file)
+    
     # Converts format
     converted = convert_to_srx(input_file, pixel_size, frames_per_section, segmented, decoded)
 
@@ -106,12 +121,15 @@ def picasso_to_srx(input_file: str,
     # Generates output file name prefix
     file_base = os.path.basename(input_file)
     file_stem = lu.clean_filename(file_base)
-    out_name = f'{file_stem}.csv'
+    out_name = f'{file_stem}.{out_format}'
 
     out_name = os.path.join(out_path, out_name)
 
     # Outputs a converted file.
-    converted.to_csv(out_name, index=False)
+    if out_format == 'parquet':
+        pq.write_table(pa.Table.from_pandas(converted, preserve_index=False), out_name, compression='zstd')
+    else:
+        converted.to_csv(out_name, index=False)
 
 
 def convert_to_srx(input_file: str,
@@ -122,41 +140,90 @@ def convert_to_srx(input_file: str,
                    ) -> pd.DataFrame:
     
     locs_data = lu.read_locs(input_file)
-    locs_data = locs_data.reset_index()
-    converted = pd.DataFrame(columns=SRX_COL)
     
-    if segmented:
-        if 'hdbscan' in locs_data.columns:
-            locs_data = locs_data[locs_data['hdbscan'] != -1]
-            converted['cluster-ID'] = locs_data['hdbscan']
-        else:
-            locs_data = locs_data[locs_data['dbscan'] != -1]
-            converted['cluster-ID'] = locs_data['dbscan']
+    # Picks the conversion once per file, so the common plain case skips the optional columns.
+    converters = {
+        (False, False): _convert_plain,
+        (False, True): _convert_decoded,
+        (True, False): _convert_segmented,
+        (True, True): partial(_convert_segmented, decoded=True),
+    }
     
-    locs_data = lu.convert_xy(locs_data, pixel_size)
+    return converters[(segmented, decoded)](locs_data, pixel_size, frames_per_section)
+
+
+def _convert_plain(locs_data: pd.DataFrame, pixel_size: float, frames_per_section: int) -> pd.DataFrame:
     
-    converted['image-ID'] = locs_data['index']
-    converted['z-step'] = locs_data['frame'] // frames_per_section
-    converted['frame'] = locs_data['frame'] % frames_per_section
+    srx_data = _srx_data(locs_data, np.arange(len(locs_data)), pixel_size, frames_per_section)
     
-    if 'n' in locs_data.columns:
-        converted['accum'] = locs_data['n']
-    converted['photon-count'] = locs_data['photons']
-    converted['photon-count11'] = locs_data['photons'] / 2.0
-    converted['photon-count12'] = locs_data['photons'] / 2.0
-    converted['x'] = locs_data['x_nm']
-    converted['y'] = locs_data['y_nm']
-    converted['z'] = locs_data['z']
-    converted['background11'] = locs_data['bg'] / 2.0
-    converted['background12'] = locs_data['bg'] / 2.0
-    converted['valid'] = 1
-    converted['precisionx'] = locs_data['lpx_nm']
-    converted['precisiony'] = locs_data['lpy_nm']
-    converted['precisionz'] = locs_data['d_zcalib']
+    return _to_srx_table(srx_data)
+
+
+def _convert_decoded(locs_data: pd.DataFrame, pixel_size: float, frames_per_section: int) -> pd.DataFrame:
+    
+    srx_data = _srx_data(locs_data, np.arange(len(locs_data)), pixel_size, frames_per_section)
+    srx_data['probe'] = locs_data['id'].to_numpy()
+    
+    return _to_srx_table(srx_data)
+
+
+def _convert_segmented(locs_data: pd.DataFrame,
+                       pixel_size: float,
+                       frames_per_section: int,
+                       decoded: bool = False
+                       ) -> pd.DataFrame:
+    
+    # Drops unclustered locs but keeps each loc's position in the file as its image-ID.
+    cluster_col = 'hdbscan' if 'hdbscan' in locs_data.columns else 'dbscan'
+    keep = locs_data[cluster_col].to_numpy() != -1
+    locs_data = locs_data[keep]
+    
+    srx_data = _srx_data(locs_data, np.flatnonzero(keep), pixel_size, frames_per_section)
+    srx_data['cluster-ID'] = locs_data[cluster_col].to_numpy()
     
     if decoded:
-        converted['probe'] = locs_data['id']
-        
+        srx_data['probe'] = locs_data['id'].to_numpy()
+    
+    return _to_srx_table(srx_data)
+
+
+def _srx_data(locs_data: pd.DataFrame, image_id: np.ndarray, pixel_size: float, frames_per_section: int) -> dict:
+    
+    # Computes each derived array once; the table is built in one constructor call.
+    z_step, section_frame = np.divmod(locs_data['frame'].to_numpy(), frames_per_section)
+    photons = locs_data['photons'].to_numpy()
+    bg_half = locs_data['bg'].to_numpy() * 0.5
+    photons_half = photons * 0.5
+    
+    srx_data = {
+        'image-ID': image_id,
+        'z-step': z_step.astype(np.int32),
+        'frame': section_frame.astype(np.int32),
+        'photon-count': photons,
+        'photon-count11': photons_half,
+        'photon-count12': photons_half,
+        'x': locs_data['x'].to_numpy() * pixel_size,
+        'y': locs_data['y'].to_numpy() * pixel_size,
+        'z': locs_data['z'].to_numpy(),
+        'background11': bg_half,
+        'background12': bg_half,
+        'valid': 1,
+        'precisionx': locs_data['lpx'].to_numpy() * pixel_size,
+        'precisiony': locs_data['lpy'].to_numpy() * pixel_size,
+        'precisionz': locs_data['d_zcalib'].to_numpy(),
+    }
+    
+    # Linked locs carry the number of merged locs.
+    if 'n' in locs_data.columns:
+        srx_data['accum'] = locs_data['n'].to_numpy()
+    
+    return srx_data
+
+
+def _to_srx_table(srx_data: dict) -> pd.DataFrame:
+    
+    # Fills the SRX columns without a Picasso counterpart with 0.
+    converted = pd.DataFrame(srx_data).reindex(columns=SRX_COL, fill_value=0)
     converted.fillna(0, inplace=True)
     
     return converted
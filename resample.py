@@ -5,10 +5,12 @@ SCRIPT_NAME = 'resample.py'
 VERSION = 1.0
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import os
 import locsutil as lu
 import time
-import pandas as pd
+import numpy as np
 from glob import glob
 _PIXEL_SIZE = 65.0
 
@@ -59,9 +61,10 @@ def main():
     if os.path.isdir(input_path):
         query = os.path.join(input_path, '*.hdf5')
         locs_files = glob(query)
-        for file in locs_files:
-            print('Converting...' + file)
-            resample(file, freq, out_path)
+        
+        # Resamples files in parallel, one process per file.
+        with ProcessPoolExecutor() as executor:
+            list(executor.map(resample, locs_files, repeat(freq), repeat(out_path)))
     else:
         resample(input_path, freq, out_path)
 
@@ -82,37 +85,38 @@ def resample(file: str, freq: int, out_path: str) -> None:
     None
 
     """
-    # Imports a hdf5 file
-    data = lu.read_locs(file)
+    print('Converting...' + file)
+    
+    # Imports a hdf5 file and converts it to the output record layout once for all subsets
+    data = lu.to_locs_records(lu.read_locs(file))
 
     # Imports a yaml file
-    yaml_in = file.rstrip('hdf5') + 'yaml'
+    yaml_in = os.path.splitext(file)[0] + '.yaml'
     frame_val, height_val, width_val = lu.read_yaml(yaml_in)
     
-    resampled = make_resampled_list(data, freq)
-    
     # Creates output prefix
     file_base = os.path.basename(file)
     file_stem = lu.clean_filename(file_base)
     
-    for i in range(len(resampled)):
+    # Writes each subset as soon as it is drawn, so only one subset is held at a time
+    for i, resampled in enumerate(iter_resampled(data, freq)):
         out_name = f'{file_stem}_{i + 1}'
         
         out_hdf5_name = os.path.join(out_path, out_name) + '.hdf5'
         out_yaml_name = os.path.join(out_path, out_name) + '.yaml'
         
         # Output cropped files
-        lu.write_locs(resampled[i], out_hdf5_name)
-        lu.write_yaml(str(len(resampled[i])), height_val, width_val, out_yaml_name)
+        lu.write_locs_records(resampled, out_hdf5_name)
+        lu.write_yaml(str(len(resampled)), height_val, width_val, out_yaml_name)
 
 
-def make_resampled_list(locs_data: pd.DataFrame, freq: int) -> list:
+def make_resampled_list(locs_data, freq: int) -> list:
     """
     Makes series of localizations resampled.
     
     Parameters
     ----------
-    locs_data : pd.DataFrame
+    locs_data : pd.DataFrame or np.ndarray
     freq : int
 
     Returns
@@ -120,13 +124,28 @@ def make_resampled_list(locs_data: pd.DataFrame, freq: int) -> list:
     list
 
     """
-    out_list = []
+    return list(iter_resampled(locs_data, freq))
+
+
+def iter_resampled(locs_data, freq: int):
+    """
+    Yields series of localizations resampled, one at a time.
     
-    for i in range(1, freq):
-        fraction = i / freq
-        out_list.append(locs_data.sample(frac=fraction, random_state=1))
+    Parameters
+    ----------
+    locs_data : pd.DataFrame or np.ndarray
+    freq : int
+
+    Returns
+    -------
+    generator
+
+    """
+    # Draws one permutation and takes growing prefixes of it, each sorted to keep the frame order.
+    perm = np.random.default_rng(1).permutation(len(locs_data))
     
-    return out_list
+    for i in range(1, freq):
+        yield locs_data.take(np.sort(perm[:round(len(locs_data) * i / freq)]))
 
 
 if __name__ == '__main__':
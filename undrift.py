@@ -5,6 +5,9 @@ SCRIPT_NAME = 'undrift.py'
 VERSION = 1.0
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
 import pandas as pd
 import os
 import locsutil as lu
@@ -101,48 +104,90 @@ def main():
     locs_file_names = drift.columns.values
     print(locs_file_names)
     print(drift[locs_file_names[1]])
+    
+    # Extracts each file's drift values once as a plain array.
+    drift_map = {item: drift[item].to_numpy(dtype=np.float64) for item in locs_file_names}
 
     # Makes a directory for output.
     output_dir = os.path.join(work_dir, 'undrifted')
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # Processes each file.
-    for item in locs_file_names:
-        
-        print(item)
-        
-        # Imports a hdf5 file as pd.DataFrame.
-        locs_file = os.path.join(work_dir, item)
-        locs_data = lu.read_locs(locs_file + '.hdf5')
-        
-        # Imports a yaml file
-        yaml_in = os.path.join(work_dir, (item + '.yaml'))
-        frame_val, height_val, width_val = lu.read_yaml(yaml_in)
-
-        # Processes an imported hdf5 file
-        out_data = lu.clean_locs(
-            locs_data, max_dzcalib, max_locs_precision, min_z, max_z, max_photons)
-        out_data = translate(out_data, drift[item])
-
-        # Generates output file name prefix.
-        file_base = os.path.basename(locs_file)
-        file_stem = lu.clean_filename(file_base)
-        if output_file:
-            outname = f'{file_stem}_{output_file}'
-        else:
-            outname = f'{file_stem}_undrifted'
-        out_hdf5_name = os.path.join(output_dir, outname) + '.hdf5'
-        out_yaml_name = os.path.join(output_dir, outname) + '.yaml'
-
-        # Outputs drift-corrected files.
-        lu.write_locs(out_data, out_hdf5_name)
-        lu.write_yaml(frame_val, height_val, width_val, out_yaml_name)
+    # Processes each file in a separate process.
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(undrift_file, locs_file_names, (drift_map[item] for item in locs_file_names),
+                          repeat(work_dir), repeat(output_dir), repeat(output_file),
+                          repeat(max_dzcalib), repeat(max_locs_precision), repeat(min_z), repeat(max_z),
+                          repeat(max_photons)))
         
     return None
 
 
-def translate(locs_data: pd.DataFrame, drift: pd.Series) -> pd.DataFrame:
+def undrift_file(item: str,
+                 drift: np.ndarray,
+                 work_dir: str,
+                 output_dir: str,
+                 output_file: str,
+                 max_dzcalib: float,
+                 max_lp: float,
+                 min_z: float,
+                 max_z: float,
+                 max_photons: int
+                 ) -> None:
+    """
+    Cleans and translates one localization file and writes the undrifted files.
+    
+    Parameters
+    ----------
+    item : str
+        Localization file name without extension, relative to work_dir.
+    drift : np.ndarray
+        Drift values for x, y, and z (optional)
+    work_dir : str
+    output_dir : str
+    output_file : str
+        Output file postfix, or None.
+    max_dzcalib : float
+    max_lp : float
+    min_z : float
+    max_z : float
+    max_photons : int
+    
+    Returns
+    -------
+    None
+    
+    """
+    
+    print(item)
+    
+    locs_file = os.path.join(work_dir, item)
+    
+    # Imports a yaml file
+    yaml_in = os.path.join(work_dir, (item + '.yaml'))
+    frame_val, height_val, width_val = lu.read_yaml(yaml_in)
+
+    # Imports a hdf5 file as pd.DataFrame and processes it; only the cleaned frame is kept.
+    out_data = lu.clean_locs(
+        lu.read_locs(locs_file + '.hdf5'), max_dzcalib, max_lp, min_z, max_z, max_photons)
+    out_data = translate(out_data, drift)
+
+    # Generates output file name prefix.
+    file_base = os.path.basename(locs_file)
+    file_stem = lu.clean_filename(file_base)
+    if output_file:
+        outname = f'{file_stem}_{output_file}'
+    else:
+        outname = f'{file_stem}_undrifted'
+    out_hdf5_name = os.path.join(output_dir, outname) + '.hdf5'
+    out_yaml_name = os.path.join(output_dir, outname) + '.yaml'
+
+    # Outputs drift-corrected files.
+    lu.write_locs(out_data, out_hdf5_name)
+    lu.write_yaml(frame_val, height_val, width_val, out_yaml_name)
+
+
+def translate(locs_data: pd.DataFrame, drift: np.ndarray) -> pd.DataFrame:
     """
     Translates localization data
     
@@ -150,7 +195,7 @@ def translate(locs_data: pd.DataFrame, drift: pd.Series) -> pd.DataFrame:
     ----------
     locs_data : pd.DataFrame
         Localization data containing x, y, and z (optional)
-    drift : pd.Series
+    drift : np.ndarray
         Drift values for x, y, and z (optional)
     
     Returns
@@ -159,13 +204,15 @@ def translate(locs_data: pd.DataFrame, drift: pd.Series) -> pd.DataFrame:
         Localization data with drift-corrected x, y, and z (optional)
     
     """
-    drift_list = drift.values.tolist()
+    # Subtracts on the underlying arrays, skipping pandas alignment.
+    shifts = {'x': float(drift[1]), 'y': float(drift[0])}
 
-    locs_data['x'] -= float(drift_list[1])
-    locs_data['y'] -= float(drift_list[0])
+    if len(drift) == 3:
+        shifts['z'] = float(drift[2])
 
-    if len(drift_list) == 3:
-        locs_data['z'] -= float(drift_list[2])
+    for col, shift in shifts.items():
+        values = locs_data[col].to_numpy()
+        locs_data[col] = values - values.dtype.type(shift)
 
     return locs_data
 
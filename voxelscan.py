@@ -5,6 +5,9 @@ SCRIPT_NAME = 'voxelscan.py'
 VERSION = 1.0
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
 import pandas as pd
 import os
 import locsutil as lu
@@ -18,7 +21,7 @@ COLUMNS = ['file', 'expdate', 'roi', 'subroi',
 
 MESSAGE = f"""
 %s version %s. Requires a path to a directory containing Dedode-PAINT localization files to be analyzed.
-Optionally takes in other parameters. Returns a result table (CSV).
+Optionally takes in other parameters. Returns a result table (CSV or Parquet).
 """ % (SCRIPT_NAME, VERSION)
 
 
@@ -35,6 +38,7 @@ def main():
     
     cutoff : int, optional
     output : str, optional
+    format : str, optional
     
     Returns
     -------
@@ -62,6 +66,8 @@ def main():
                             help='Localization number cutoff.')
     user_input.add_argument('-o', '--output', action='store', type=str, default='analyzed',
                             help='The output file name postfix.')
+    user_input.add_argument('-t', '--format', action='store', type=str, choices=['csv', 'parquet'],
+                            default='csv', help='Output file format, default = csv.')
     
     args = user_input.parse_args()
     input_path = args.dir
@@ -71,36 +77,42 @@ def main():
     bin_step = args.binsize_step
     cutoff = args.cutoff
     out_postfix = args.output
+    out_format = args.format
 
     # Count process time
     start = time.time()
 
     # Find data files
-    os.chdir(input_path)
-    hdf5_list = lu.get_hdf_list()
+    hdf5_list = lu.get_hdf_list(input_path)
     print(hdf5_list)
     
-    all_data = pd.DataFrame(columns=COLUMNS)
+    # Analyze each file in a separate process and generate output table
+    with ProcessPoolExecutor() as executor:
+        analyzed_list = list(executor.map(analyze_vox, hdf5_list, repeat(bin_min), repeat(bin_max),
+                                          repeat(bin_step), repeat(pixel_size), repeat(cutoff)))
 
-    # Analyze each file and generate output table
-    for item in hdf5_list:
-        print('Analyzing...' + item)
-
-        analyzed = analyze_vox(item, bin_min, bin_max, bin_step, pixel_size, cutoff)
-        all_data = pd.concat([all_data, analyzed], ignore_index=True)
-        print(f'Elapsed_time: {time.time() - start} [sec]')
+    # Concatenates the per-file tables, which share one schema, so dtypes are kept.
+    # Files without any id above the cutoff add no rows and are left out of the concat.
+    analyzed_list = [analyzed for analyzed in analyzed_list if len(analyzed)]
+    all_data = pd.concat(analyzed_list, ignore_index=True) if analyzed_list else pd.DataFrame(columns=COLUMNS)
 
     # Outputs table.
     now = datetime.now().strftime('%Y-%m-%d-%H%M%S')
-    outname = f'{out_postfix}_co{cutoff}_{now}.csv'
-    all_data = all_data[COLUMNS]
-    all_data.to_csv(outname)
+    outname = os.path.join(input_path, f'{out_postfix}_co{cutoff}_{now}.{out_format}')
+    all_data = all_data.reindex(columns=COLUMNS)
+    
+    if out_format == 'parquet':
+        all_data.to_parquet(outname, engine='pyarrow', compression='zstd')
+    else:
+        all_data.to_csv(outname)
 
     print(f'Total_time: {time.time() - start} [sec]')
     
 
 def analyze_vox(file: str, bin_min: int, bin_max: int, step: int, pixel_size: float, cutoff: int):
     
+    print('Analyzing...' + file)
+    
     data = lu.read_locs(file)
     data = lu.convert_xy(data, pixel_size)
     
@@ -114,89 +126,89 @@ def analyze_vox(file: str, bin_min: int, bin_max: int, step: int, pixel_size: fl
     
     analyzed = _analyze_vox(data, bin_min, bin_max, step, cutoff)
 
-    analyzed['file'] = file
-    analyzed['status'] = lu.get_status(file)
+    analyzed['file'] = os.path.basename(file)
+    analyzed['status'] = lu.get_status(os.path.basename(file))
     
     return analyzed
 
 
 def _analyze_vox(locs: pd.DataFrame, bin_min: int, bin_max: int, step: int, cutoff: int):
     
-    _id = []
-    total_locs = []
-    num_clusters = []
-    bins = []
-    vols = []
-    surfs = []
-    stovs = []
-    core_ratios = []
-    params = []
-    
-    for i, locs_group in locs.groupby('id'):
-        
-        if len(locs_group) < cutoff:
-            pass
-        
-        else:
-            _id += [i]
-            
-            total_locs += [len(locs_group)]
-            num_clusters += [len(locs_group['hdbscan'].unique())]
-            bin_list, vol_list, surf_list, stov_list, core_ratio_list = voxel_scan(locs_group, bin_min, bin_max, step)
-            bins += [int2str(bin_list)]
-            vols += [int2str(vol_list)]
-            surfs += [int2str(surf_list)]
-            stovs += [int2str(stov_list)]
-            core_ratios += [int2str(core_ratio_list)]
+    # Selects the ids with enough locs and scans all of them together.
+    sizes = locs.groupby('id').size()
+    _id = sizes.index[sizes >= cutoff]
+    
+    # A file without any id above the cutoff gives an empty table.
+    if len(_id) == 0:
+        return pd.DataFrame(columns=['id', 'total_locs', 'clusters', 'vox_bins', 'total_vol', 'total_surf',
+                                     's_to_v', 'core_ratios', 'sigmoid_params'])
+    
+    locs = locs[locs['id'].isin(_id)]
+    codes = _id.get_indexer(locs['id'])
+    
+    total_locs = sizes[_id].to_numpy()
+    num_clusters = locs.groupby('id')['hdbscan'].nunique().reindex(_id).to_numpy()
+    
+    bin_list, vols, surfs, stovs, core_ratios = voxel_scan(locs, codes, len(_id), bin_min, bin_max, step)
+    
+    # One slot per id; ids whose fit fails are left empty so every column keeps the same length.
+    params = np.full(len(_id), None, dtype=object)
+    
+    for k in range(len(_id)):
+        try:
+            popt, _ = lu.fit_sigmoid(bin_list, core_ratios[k].tolist())
+            params[k] = int2str([popt[0], popt[1], popt[2]])
             
-            try:
-                popt, _ = lu.fit_sigmoid(bin_list, core_ratio_list)
-                params += [int2str([popt[0], popt[1], popt[2]])]
-                
-            except RuntimeError:
-                print('RuntimeErrorException: Fitting failed')
+        except RuntimeError:
+            print('RuntimeErrorException: Fitting failed')
     
     ret_df = pd.DataFrame(
-        data={'id': _id, 'total_locs': total_locs, 'clusters': num_clusters, 'vox_bins': bins,
-              'total_vol': vols, 'total_surf': surfs, 's_to_v': stovs,
-              'core_ratios': core_ratios, 'sigmoid_params': params},
+        data={'id': _id, 'total_locs': total_locs, 'clusters': num_clusters,
+              'vox_bins': [int2str(bin_list)] * len(_id),
+              'total_vol': [int2str(row) for row in vols], 'total_surf': [int2str(row) for row in surfs],
+              's_to_v': [int2str(row) for row in stovs],
+              'core_ratios': [int2str(row) for row in core_ratios], 'sigmoid_params': params},
     )
     
     return ret_df
 
 
-def voxel_scan(locs: pd.DataFrame, bin_min: int, bin_max: int, step: int):
+def voxel_scan(locs: pd.DataFrame, codes: np.ndarray, n_ids: int, bin_min: int, bin_max: int, step: int):
+    # Scans the voxels of all ids at once per bin size. codes holds the position of each loc's id.
+    # Returns the bin sizes and one row per id of each measure, one column per bin size.
     
-    bin_list = []
-    vol_list = []
-    surf_list = []
-    stov_list = []
-    core_ratio_list = []
+    bin_list = list(range(bin_min, bin_max, step))
     
-    for bin in range(bin_min, bin_max, step):
-        data = locs.copy()
-        data = lu.voxelize(data, bin, bin)
-        calculated, total_vox, surf_vox, xy_faces, z_faces = lu.count_exposed_faces(data)
-        
-        bin_list.append(bin)
-        
-        total_vol = total_vox * (bin ** 3)
-        total_surf = (xy_faces + z_faces) * (bin ** 2)
-        normalized_stov = total_surf / (total_vol ** (2 / 3))
+    vols = np.empty((n_ids, len(bin_list)), dtype=np.int64)
+    surfs = np.empty((n_ids, len(bin_list)), dtype=np.int64)
+    stovs = np.empty((n_ids, len(bin_list)), dtype=np.float64)
+    core_ratios = np.empty((n_ids, len(bin_list)), dtype=np.float64)
+    
+    # Extracts the coordinates once; each bin size only divides them into voxel indices.
+    xyz = locs[['x_nm', 'y_nm', 'z']].to_numpy(dtype=np.float64)
+    scaled = np.empty_like(xyz)
+    
+    for b, bin in enumerate(bin_list):
+        vox = np.floor_divide(xyz, bin, out=scaled).astype(np.int32)
+        total_vox, surf_vox, xy_faces, z_faces = lu.count_exposed_faces_grouped(codes, vox, n_ids)
         
-        vol_list.append(total_vol)
-        surf_list.append(total_surf)
-        stov_list.append(normalized_stov)
-        core_ratio_list.append((total_vox - surf_vox) / total_vox)
+        vols[:, b] = total_vox * (bin ** 3)
+        surfs[:, b] = (xy_faces + z_faces) * (bin ** 2)
+        stovs[:, b] = surfs[:, b] / (vols[:, b] ** (2 / 3))
+        core_ratios[:, b] = (total_vox - surf_vox) / total_vox
         
-        print(f'Bin size: {bin} nm, Core vox ratio: {(total_vox - surf_vox) / total_vox}')
+        print(f'Bin size: {bin} nm, Core vox ratio: {core_ratios[:, b]}')
     
-    return bin_list, vol_list, surf_list, stov_list, core_ratio_list
+    return bin_list, vols, surfs, stovs, core_ratios
 
 
-def int2str(in_list: list) -> list:
+def int2str(in_list: list) -> str:
+    
+    # Formats all items in one numpy call; integers with '%d', floats with their shortest repr.
+    arr = np.asarray(in_list)
+    parts = np.char.mod('%d', arr) if arr.dtype.kind in 'iu' else arr.astype(str)
     
-    return ",".join([str(i) for i in in_list])
+    return ",".join(parts.tolist())
 
 
 if __name__ == '__main__':